@@ -1,5 +1,8 @@
-from .fmap import fmap_for, on_keys
-from .dispatch import dispatch_on, instance
-from .pattern_match import pattern_match, pattern_matching
-from .tcall import tcall
+from .fmap import fmap_for, on_keys, pfmap, fmap_lazy, lazy_fmap_for, \
+    fmap_inplace, inplace_fmap_for, afmap
+from .dispatch import dispatch_on, dispatch_on_value, instance
+from .pattern_match import pattern_match, pattern_matching, compile_pattern, \
+    MatchTable, match_stream, match_all, instrument_patterns, \
+    pattern_metrics, set_pattern_trace
+from .tcall import tcall, atcall, TailCall
 from .prelude import *
@@ -0,0 +1,78 @@
+'''
+Microbenchmark for the wrappers generated by dispatch_on.
+
+Compares the generated, straight-line wrappers against the previous
+closure that branched on the form of the index and built the dispatch
+key through a generator expression on every call. The single index form
+gains the least (around 1.3x on CPython 3.11) as the closure already
+computed that key directly; most of what is left is the wrapper call.
+
+    $ python benchmarks/dispatch_bench.py
+'''
+from timeit import repeat
+from functools import wraps
+
+from concepts import dispatch_on
+
+
+def closure_dispatch_on(index=0, func=None):
+    '''
+    The previous dispatch_on wrapper, kept for comparison. Resolution is
+    reduced to an exact type lookup so only the per-call key computation
+    is being measured.
+    '''
+    if func is None:
+        return lambda f: closure_dispatch_on(index, f)
+
+    implementations = {}
+    multi = index == 'all' or type(index) == tuple
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        if multi:
+            if index == 'all':
+                dispatch_key = tuple(type(a) for a in args)
+            else:
+                dispatch_key = tuple(type(args[i]) for i in index)
+        else:
+            dispatch_key = type(args[index])
+
+        implementation = implementations.get(dispatch_key, func)
+        return implementation(*args, **kwargs)
+
+    wrapped.add = lambda key, f: implementations.__setitem__(key, f)
+    return wrapped
+
+
+def build(decorator, index, key):
+    @decorator(index)
+    def target(a, b, c):
+        return None
+
+    target.add(key, lambda a, b, c: None)
+    return target
+
+
+CASES = [
+    ('single index', 1, str),
+    ('tuple index', (0, 2), (int, float)),
+    ("'all'", 'all', (int, str, float)),
+]
+
+
+def main(number=200000, runs=5):
+    print('{:<14} {:>12} {:>14} {:>8}'.format(
+        'index', 'closure (s)', 'generated (s)', 'speedup'))
+    for name, index, key in CASES:
+        timings = []
+        for decorator in (closure_dispatch_on, dispatch_on):
+            target = build(decorator, index, key)
+            timings.append(min(repeat(
+                lambda: target(1, 'a', 1.0), number=number, repeat=runs)))
+        old, new = timings
+        print('{:<14} {:>12.4f} {:>14.4f} {:>7.2f}x'.format(
+            name, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+'''
+Benchmark showing how pattern matching scales with the length of the target.
+
+Greedy variables and repeating sub-templates are matched with index
+cursors over the target, so the time per element should stay flat as
+the target grows.
+
+    $ python benchmarks/pattern_bench.py
+'''
+from timeit import repeat
+from collections import deque, UserList
+
+from concepts import compile_pattern
+
+
+CASES = [
+    ('(head *body last)', lambda n: list(range(n))),
+    ('((k v) ...)', lambda n: [(i, -i) for i in range(n)]),
+    ('(*a (b c) ...)', lambda n: list(range(n // 2)) +
+        [(i, -i) for i in range(n // 2)]),
+    ('(*a x (b c) ...)', lambda n: list(range(n // 2)) +
+        [(i, -i) for i in range(n // 2)]),
+    # Sequences that can't be sliced (or slice to their own type)
+    ('(head *body last)', lambda n: deque(range(n))),
+    ('(head *body last)', lambda n: UserList(range(n))),
+]
+
+
+def main(sizes=(1000, 10000, 100000), runs=5):
+    print('{:<20} {:<9} {:>8} {:>12} {:>16}'.format(
+        'pattern', 'target', 'length', 'time (s)', 'ns per element'))
+    for pattern, make_target in CASES:
+        matcher = compile_pattern(pattern)
+        for n in sizes:
+            target = make_target(n)
+            assert matcher.match(target) is not None
+            number = max(1, 100000 // n)
+            elapsed = min(repeat(
+                lambda: matcher.match(target), number=number, repeat=runs))
+            elapsed /= number
+            print('{:<20} {:<9} {:>8} {:>12.6f} {:>16.1f}'.format(
+                pattern, type(target).__name__, n, elapsed, 1e9 * elapsed / n))
+
+
+if __name__ == '__main__':
+    main()
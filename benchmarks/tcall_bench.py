@@ -0,0 +1,126 @@
+'''
+Benchmark for the tcall trampoline.
+
+Compares the previous loop, which unpacked every result inside a
+try/except to decide whether it was a tail call, against explicit
+TailCall objects with and without the tuple compatibility mode, and
+against functions rewritten into loops with @tcall(loop=True).
+
+    $ python benchmarks/tcall_bench.py
+'''
+from timeit import repeat
+from functools import wraps
+
+from concepts import tcall, TailCall
+
+
+def loop_tcall(func):
+    '''
+    The previous tcall trampoline, kept for comparison.
+    '''
+    original = func
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        f = func
+
+        while f:
+            result = f(*args, **kwargs)
+            try:
+                f, *result_or_args = result
+                if not callable(f):
+                    return result
+            except TypeError:
+                return result
+
+            f = f._original if getattr(f, '_tcalling', None) else f
+
+            if len(result_or_args) > 2 or len(result_or_args) == 0:
+                raise IndexError(
+                    'tcall functions must return (func, args, kwargs)'
+                    ' or (func, args)')
+
+            try:
+                args, kwargs = result_or_args
+            except ValueError:
+                args, kwargs = result_or_args[0], {}
+
+    wrapped._tcalling = True
+    wrapped._original = original
+    return wrapped
+
+
+def tuple_fact(decorator):
+    @decorator
+    def fact(n, acc=1):
+        if n == 0:
+            return acc
+        return fact, (n-1, acc*n)
+    return fact
+
+
+def object_fact(decorator):
+    @decorator
+    def fact(n, acc=1):
+        if n == 0:
+            return acc
+        return TailCall(fact, n-1, acc*n)
+    return fact
+
+
+def tuple_count(decorator):
+    @decorator
+    def count(n):
+        if n == 0:
+            return n
+        return count, (n-1,)
+    return count
+
+
+def object_count(decorator):
+    @decorator
+    def count(n):
+        if n == 0:
+            return n
+        return TailCall(count, n-1)
+    return count
+
+
+# Closures can't be rewritten into loops so these live at module level
+@tcall(loop=True)
+def loop_fact(n, acc=1):
+    if n == 0:
+        return acc
+    return TailCall(loop_fact, n-1, acc*n)
+
+
+@tcall(loop=True)
+def loop_count(n):
+    if n == 0:
+        return n
+    return TailCall(loop_count, n-1)
+
+
+VARIANTS = [
+    ('previous loop', tuple_count, tuple_fact, loop_tcall),
+    ('tuples', tuple_count, tuple_fact, tcall),
+    ('TailCall', object_count, object_fact, tcall),
+    ('TailCall only', object_count, object_fact, tcall(tuples=False)),
+    ('loop', lambda _: loop_count, lambda _: loop_fact, None),
+]
+
+
+def main(n=9999, number=20, runs=5):
+    print('{:<14} {:>16} {:>16}'.format(
+        'trampoline', 'countdown (s)', 'fact (s)'))
+    for name, count_for, fact_for, decorator in VARIANTS:
+        timings = []
+        for build in (count_for, fact_for):
+            target = build(decorator)
+            timings.append(min(repeat(
+                lambda: target(n), number=number, repeat=runs)) / number)
+        print('{:<14} {:>16.6f} {:>16.6f}'.format(name, *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,188 @@
 Adding simple single & multiple dispatch to Python.
 ```````````````````````````````````````````````````
 
-Unlike functools.singledispatch, this will not work back through the MRO
-to find a matching superclass. Instead it will immediately resort to the
-default implementation.
+Like functools.singledispatch, lookup will work back through the MRO of
+each dispatched argument to find a matching superclass before resorting
+to the default implementation. The result of that search is cached per
+concrete type (or tuple of types) so repeated calls only pay for a single
+dict lookup. The cache is cleared whenever a new implementation is added
+or once it holds DISPATCH_CACHE_SIZE keys. Until then it keeps the types
+it has seen alive, so classes created on the fly are only collected once
+the cache has been cleared.
+
+`dispatch_on_value` is the companion for dispatching on the value of an
+argument: exact values and non-overlapping numeric style intervals.
 
 NOTE:   *args and **kwargs are _not_ allowed in the signature of the
-        function being defined.
+        function being defined. ('all' dispatches on the positional
+        parameters only.)
 '''
+from time import perf_counter
 from functools import wraps
+from itertools import product
+from bisect import bisect_left, bisect_right
+
+
+# Maximum number of concrete keys to cache for each dispatching function
+DISPATCH_CACHE_SIZE = 1024
+
+
+# Source for the specialised wrapper generated by dispatch_on. The key
+# computation is filled in at decoration time so that the call path is
+# straight-line code with no branching on the form of the index. Calls
+# without keyword arguments - the common case - never touch kwargs;
+# anything else is normalised by by_keyword first.
+_WRAPPER_TEMPLATE = '''
+def by_keyword(args, kwargs):
+    args, kwargs = normalise(args, kwargs)
+{keyword_key_lines}
+    try:
+        implementation = resolved[dispatch_key]
+    except KeyError:
+        implementation = resolve(dispatch_key)
+    return implementation(*args, **kwargs)
+
+def wrapped(*args, **kwargs):
+    if kwargs:
+        return by_keyword(args, kwargs)
+{key_lines}
+    try:
+        implementation = resolved[dispatch_key]
+    except KeyError:
+        implementation = resolve(dispatch_key)
+    return implementation(*args)
+'''
+
+
+class _Missing:
+    '''
+    Stand-in for a required argument that was not supplied. Dispatching
+    on it will find the default (or an `object` implementation) which
+    then raises the usual TypeError for the missing argument.
+    '''
+
+
+def _parameters(func):
+    '''
+    Work out, once, the (name, default) pairs for the positional and
+    keyword only parameters of func.
+    '''
+    code = func.__code__
+    n_positional = code.co_argcount
+    names = code.co_varnames[:n_positional + code.co_kwonlyargcount]
+    defaults = func.__defaults__ or ()
+    kwdefaults = func.__kwdefaults__ or {}
+    first_default = n_positional - len(defaults)
+
+    positional = tuple(
+        (name, defaults[i - first_default] if i >= first_default else _Missing)
+        for i, name in enumerate(names[:n_positional]))
+    keyword_only = tuple(
+        (name, kwdefaults.get(name, _Missing))
+        for name in names[n_positional:])
+
+    return positional, keyword_only
+
+
+def _make_normaliser(positional):
+    '''
+    Build a function that moves positional parameters that were passed by
+    keyword into args so that implementations - which are free to name
+    their parameters differently - always receive them positionally.
+    Skipped parameters are filled with their default. We stop at the first
+    required parameter that is missing and leave that to the call itself
+    to complain about.
+    '''
+    def normalise(args, kwargs):
+        if len(args) >= len(positional):
+            return args, kwargs
+
+        kwargs = dict(kwargs)
+        extra = []
+        # Trailing defaults are left for the implementation to fill in
+        trailing_defaults = 0
+        for name, default in positional[len(args):]:
+            if name in kwargs:
+                extra.append(kwargs.pop(name))
+                trailing_defaults = 0
+            elif default is not _Missing:
+                extra.append(default)
+                trailing_defaults += 1
+            else:
+                break
+
+        if trailing_defaults:
+            del extra[-trailing_defaults:]
+
+        return args + tuple(extra), kwargs
+
+    return normalise
 
 
-def dispatch_on(index=0, func=None):
+def _key_lines(indices, multi, positional, keyword_only, namespace,
+               keywords=True):
+    '''
+    Generate the source that computes `dispatch_key` for the dispatched
+    parameters. By the time this runs, positional parameters are always
+    in args (if they were supplied at all) and keyword only parameters
+    are looked up by name, or take their default if keywords is False.
+    '''
+    fast, slow = [], []
+    for n, i in enumerate(indices):
+        if i < len(positional):
+            name, default = positional[i]
+            namespace['_default_{}'.format(n)] = default
+            fast.append('type(args[{}])'.format(i))
+            slow.append('type(args[{0}] if len(args) > {0} else _default_{1})'
+                        .format(i, n))
+        elif i < len(positional) + len(keyword_only):
+            name, default = keyword_only[i - len(positional)]
+            namespace['_default_{}'.format(n)] = default
+            if keywords:
+                fast.append('type(kwargs.get({!r}, _default_{}))'.format(
+                    name, n))
+            else:
+                fast.append('type(_default_{})'.format(n))
+            slow.append(fast[-1])
+        else:
+            raise ValueError('Invalid dispatch index: {}'.format(i))
+
+    if multi:
+        fast_key = '({},)'.format(', '.join(fast))
+        slow_key = '({},)'.format(', '.join(slow))
+    else:
+        fast_key, slow_key = fast[0], slow[0]
+
+    if fast_key == slow_key:
+        return '    dispatch_key = {}'.format(fast_key)
+    # Defaulted (or missing) positional arguments
+    return ('    try:\n'
+            '        dispatch_key = {}\n'
+            '    except IndexError:\n'
+            '        dispatch_key = {}').format(fast_key, slow_key)
+
+
+def _compile_wrapper(func, indices, multi, resolved, resolve):
+    '''
+    Build a wrapper function specialised for the dispatched arguments.
+    '''
+    positional, keyword_only = _parameters(func)
+    namespace = {
+        'resolved': resolved,
+        'resolve': resolve,
+        'normalise': _make_normaliser(positional),
+    }
+    source = _WRAPPER_TEMPLATE.format(
+        keyword_key_lines=_key_lines(
+            indices, multi, positional, keyword_only, namespace),
+        key_lines=_key_lines(
+            indices, multi, positional, keyword_only, namespace,
+            keywords=False))
+    exec(source, namespace)
+    return namespace['wrapped']
+
+
+def dispatch_on(index=0, func=None, instrument=False):
     '''
     Allow the implementation of a function to vary based on the type of
     of its arguments.
@@ -22,30 +193,54 @@ def dispatch_on(index=0, func=None):
         a tuple of indices -->  dispatch_on((0,2))
         all arguments      -->  dispatch_on('all')
 
+    Dispatched arguments may be passed positionally or by keyword and any
+    that are omitted are dispatched on using their default value. Indices
+    past the positional parameters refer to keyword only parameters.
+
     Once the decorated function has been defined, you can use
     <original_func>.add(<types>) to register an implementation.
 
     NOTE: <types> must match the form of the original specification
           used in @dispatch_on.
 
+    Implementations registered for a superclass will be used for any of
+    its subclasses unless a more specific implementation exists. For
+    multiple dispatch, the MRO of the left-most argument takes priority.
+
     If no implementation is found, then the decorated function is used
     as a default.
+
+    Passing instrument=True (or calling <original_func>.instrument() later)
+    records the number of calls, the number of calls that fell back to the
+    default and the cumulative time spent for each dispatch key. Use
+    <original_func>.metrics() to get a snapshot of what has been recorded.
+    When instrumentation is off the call path is left untouched.
     '''
     # A quick hack to allow using this as a decorator with arguments
     if func is None:
-        return lambda f: dispatch_on(index, f)
+        return lambda f: dispatch_on(index, f, instrument)
 
     implementations = {}
+    # Resolved implementations for each concrete key seen so far. This is
+    # a plain dict rather than a WeakKeyDictionary, which is several times
+    # slower to look up, so it is bounded instead.
+    resolved = {}
+    # [calls, fallbacks, cumulative time] for each dispatch key
+    recorded = {}
+    instrumented = False
 
     if index == 'all':
         multi = True
         # Horrible but correct so long as func does not use *args or **kwargs
         key_len = func.__code__.co_argcount
+        indices = tuple(range(key_len))
     elif type(index) == tuple:
         multi = True
         key_len = len(index)
+        indices = index
     elif type(index) == int:
         multi = False
+        indices = (index,)
     else:
         raise ValueError("Invalid argument specification for dispatch")
 
@@ -65,27 +260,196 @@ def dispatch_on(index=0, func=None):
                         key_len, len(key)))
 
         implementations[key] = func
+        # Anything we have already resolved may now have a better match
+        resolved.clear()
         return func
 
-    @wraps(func)
-    def wrapped(*args, **kwargs):
+    def resolve(dispatch_key):
         '''
-        Attempt to use an implementation if there is one,
-        otherwise use the default.
+        Walk the MRO(s) of the dispatch key to find the most specific
+        registered implementation and cache the result.
         '''
         if multi:
-            if index == 'all':
-                dispatch_key = tuple(type(a) for a in args)
-            else:
-                dispatch_key = tuple(type(args[i]) for i in index)
+            candidates = product(*(t.__mro__ for t in dispatch_key))
         else:
-            dispatch_key = type(args[index])
+            candidates = dispatch_key.__mro__
+
+        for candidate in candidates:
+            if candidate in implementations:
+                implementation = implementations[candidate]
+                break
+        else:
+            implementation = func
+
+        if instrumented:
+            implementation = _timed(
+                implementation, implementation is func,
+                recorded.setdefault(dispatch_key, [0, 0, 0.0]))
 
-        implementation = implementations.get(dispatch_key, func)
-        return implementation(*args, **kwargs)
+        if len(resolved) >= DISPATCH_CACHE_SIZE:
+            resolved.clear()
+        resolved[dispatch_key] = implementation
+        return implementation
+
+    def set_instrumented(enabled=True):
+        '''
+        Turn call metrics on or off. Enabling instrumentation discards
+        anything that was previously recorded.
+        '''
+        nonlocal instrumented
+        if enabled:
+            recorded.clear()
+        instrumented = enabled
+        # Cached implementations need to be (un)wrapped
+        resolved.clear()
+
+    def metrics():
+        '''
+        Snapshot of the recorded call metrics for each dispatch key.
+        '''
+        return {
+            key: {'calls': calls, 'fallbacks': fallbacks, 'time': elapsed}
+            for key, (calls, fallbacks, elapsed) in recorded.items()
+        }
 
+    # Attempt to use an implementation if there is one,
+    # otherwise use the default.
+    wrapped = wraps(func)(
+        _compile_wrapper(func, indices, multi, resolved, resolve))
     wrapped.implementations = implementations
     wrapped.add = add
+    wrapped.instrument = set_instrumented
+    wrapped.metrics = metrics
+    wrapped._dispatching = True
+
+    if instrument:
+        set_instrumented()
+
+    return wrapped
+
+
+def _timed(implementation, fallback, stats):
+    '''
+    Wrap an implementation so that each call updates stats in place.
+    '''
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return implementation(*args, **kwargs)
+        finally:
+            stats[0] += 1
+            stats[1] += fallback
+            stats[2] += perf_counter() - start
+
+    return timed
+
+
+def dispatch_on_value(index=0, func=None):
+    '''
+    Allow the implementation of a function to vary based on the _value_
+    of one of its arguments rather than its type.
+
+    Once the decorated function has been defined you can register:
+        an exact value       -->  <original_func>.add(value)
+        a half open interval -->  <original_func>.add_range(low, high)
+
+    Exact values are held in a hash table and intervals in a sorted index
+    that is searched with bisect, so lookups do not get slower as more
+    cases are registered. Exact values take priority over intervals and
+    intervals may not overlap.
+
+    If no implementation is found, then the decorated function is used
+    as a default.
+    '''
+    # A quick hack to allow using this as a decorator with arguments
+    if func is None:
+        return lambda f: dispatch_on_value(index, f)
+
+    if type(index) != int:
+        raise ValueError("Invalid argument specification for dispatch")
+
+    positional, keyword_only = _parameters(func)
+    normalise = _make_normaliser(positional)
+    if index < len(positional):
+        name, default = positional[index]
+    elif index < len(positional) + len(keyword_only):
+        name, default = keyword_only[index - len(positional)]
+    else:
+        raise ValueError('Invalid dispatch index: {}'.format(index))
+
+    implementations = {}
+    # Parallel lists for the interval index, sorted by lower bound
+    lows, highs, ranged = [], [], []
+
+    def add(value, func=None):
+        '''
+        Add an implementation of func for an exact value.
+        '''
+        if func is None:
+            return lambda f: add(value, f)
+
+        implementations[value] = func
+        return func
+
+    def add_range(low, high, func=None):
+        '''
+        Add an implementation of func for values where low <= value < high.
+        '''
+        if func is None:
+            return lambda f: add_range(low, high, f)
+
+        if not low < high:
+            raise ValueError('Empty interval: [{}, {})'.format(low, high))
+
+        i = bisect_left(lows, low)
+        overlaps_before = i > 0 and highs[i - 1] > low
+        overlaps_after = i < len(lows) and lows[i] < high
+        if overlaps_before or overlaps_after:
+            raise ValueError(
+                'Interval [{}, {}) overlaps an existing interval'.format(
+                    low, high))
+
+        lows.insert(i, low)
+        highs.insert(i, high)
+        ranged.insert(i, func)
+        return func
+
+    def lookup(value):
+        '''
+        Find the implementation for a value, falling back to the default.
+        '''
+        try:
+            return implementations[value]
+        except (KeyError, TypeError):
+            # Not registered or not hashable
+            pass
+
+        try:
+            i = bisect_right(lows, value) - 1
+            if i >= 0 and value < highs[i]:
+                return ranged[i]
+        except TypeError:
+            # Not comparable with the interval bounds
+            pass
+
+        return func
+
+    if index < len(positional):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            if kwargs:
+                args, kwargs = normalise(args, kwargs)
+            value = args[index] if len(args) > index else default
+            return lookup(value)(*args, **kwargs)
+    else:
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            return lookup(kwargs.get(name, default))(*args, **kwargs)
+
+    wrapped.implementations = implementations
+    wrapped.add = add
+    wrapped.add_range = add_range
+    wrapped._dispatching = True
     return wrapped
 
 
@@ -97,8 +461,11 @@ def instance(func, implementation, arg_type):
     This is an alternative to explicitly wrapping the function definition
     in question with @func.add(arg_type) to allow run-time registration
     and registration of pre-defined functions.
+
+    For functions decorated with `dispatch_on_value`, arg_type is the exact
+    value to register.
     '''
-    if 'dispatch' in dir(func):
+    if getattr(func, '_dispatching', None):
         func.add(arg_type, implementation)
     else:
         raise TypeError(
@@ -1,6 +1,14 @@
+import asyncio
+from array import array, typecodes
+from struct import calcsize, pack
+from sys import byteorder
+from inspect import isawaitable
 from types import GeneratorType
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from collections import Iterator, deque, defaultdict, \
         Counter, OrderedDict, ChainMap
+from collections.abc import Sequence, Mapping
 
 from .dispatch import dispatch_on
 
@@ -17,7 +25,9 @@ def fmap(func, col):
 
     Supported collection types:
     ```````````````````````````
-    list, set, tuple, dict, bytes, bytarray, str, generator, range
+    list, set, tuple, dict, bytes, bytarray, str, generator, range,
+    array.array, memoryview
+    (and numpy.ndarray after calling `register_ndarray`)
     - fmapping over an empty collection will return
       an empty collection of the same type.
     - fmapping over None returns None.
@@ -49,15 +59,76 @@ fmap_for = fmap.add
 #      fmap(on_values(times2), {str(n): n for n in range(10)})          #
 #########################################################################
 def on_keys(func):
-    def composed(key, value):
-        return func(key), value
-    return composed
+    return _OnKeys(func)
 
 
 def on_values(func):
-    def composed(key, value):
-        return key, func(value)
-    return composed
+    return _OnValues(func)
+
+
+class _OnKeys:
+    '''
+    A module level class rather than a closure so that it can be pickled
+    and sent to pfmap's worker processes.
+    '''
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, key, value):
+        return self.func(key), value
+
+
+class _OnValues:
+    '''
+    See _OnKeys.
+    '''
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, key, value):
+        return key, self.func(value)
+
+
+def fuse(*funcs):
+    '''
+    Compose functions so that a stack of fmaps can be done in a single
+    pass with no intermediate containers:
+        fmap(fuse(f, g, h), col) == fmap(f, fmap(g, fmap(h, col)))
+
+    If any of the functions act on (key, value) pairs (i.e. on_keys or two
+    argument functions) then the single value functions are applied with
+    on_values and the result can only be fmapped over dicts, just as with
+    the individual functions.
+    '''
+    if not funcs:
+        raise TypeError('fuse requires at least one function')
+    if len(funcs) == 1:
+        return funcs[0]
+
+    # fmap applies the innermost (right-most) function first
+    funcs = funcs[::-1]
+
+    if any(_takes_pairs(f) for f in funcs):
+        funcs = [f if _takes_pairs(f) else on_values(f) for f in funcs]
+
+        def fused(key, value):
+            for f in funcs:
+                key, value = f(key, value)
+            return key, value
+    else:
+        def fused(element):
+            for f in funcs:
+                element = f(element)
+            return element
+
+    return fused
+
+
+fmap.fuse = fuse
 
 
 ######################################
@@ -99,7 +170,7 @@ def _fmap_dict(func, d):
     returns a tuple of two values.
         (Also see `on_values` and `on_keys`)
     '''
-    if func.__code__.co_argcount == 1:
+    if not _takes_pairs(func):
         func = on_values(func)
     fmapped = (func(k, v) for k, v in d.items())
     return {k: v for k, v in fmapped}
@@ -120,6 +191,57 @@ def _fmap_bytearray(func, b):
     return bytearray(map(func, b))
 
 
+@fmap_for(array)
+def _fmap_array(func, a):
+    # Results must still fit the original typecode
+    return array(a.typecode, map(func, a))
+
+
+@fmap_for(memoryview)
+def _fmap_memoryview(func, m):
+    '''
+    Map over the elements of the view (flattened in C order) and return
+    a view of the same format and shape over a new buffer. Only views of
+    a single native type are supported.
+    '''
+    code = _native_code(m)
+    # Copying into a new bytes object copes with views that aren't
+    # C-contiguous and with explicit native byte order formats (e.g. ctypes)
+    flat = memoryview(m.tobytes()).cast(code)
+    results = list(map(func, flat))
+    if code in typecodes:
+        buf = array(code, results)
+    else:
+        buf = bytearray(pack('{}{}'.format(len(results), code), *results))
+    return memoryview(buf).cast('B').cast(code, m.shape)
+
+
+def _native_code(m):
+    '''
+    The struct code for the elements of a memoryview, if they can be
+    unpacked with memoryview.cast.
+    '''
+    fmt = m.format
+    if fmt[:1] in ('@', '=', '<' if byteorder == 'little' else '>'):
+        code = fmt[1:]
+        if len(code) == 1 and m.itemsize != calcsize(code):
+            # The elements must be the size of the native type
+            code = None
+    else:
+        code = fmt
+
+    if code is None or len(code) != 1 or code not in _MEMORYVIEW_CODES:
+        msg = ('fmap is not currently defined for memoryviews of format'
+               ' {!r}.\n To add a definition, use the @fmap_for(memoryview)'
+               ' decorator.')
+        raise TypeError(msg.format(m.format))
+    return code
+
+
+# Single element native formats that memoryview.cast accepts
+_MEMORYVIEW_CODES = set('cbB?hHiIlLqQnNfdP')
+
+
 # Implementations for the collections module
 @fmap_for(deque)
 def _fmap_deque(func, d):
@@ -128,7 +250,7 @@ def _fmap_deque(func, d):
 
 @fmap_for(Counter)
 def _fmap_counter(func, c):
-    if func.__code__.co_argcount == 1:
+    if not _takes_pairs(func):
         func = on_values(func)
 
     fmapped = (func(k, v) for k, v in c.items())
@@ -137,7 +259,7 @@ def _fmap_counter(func, c):
 
 @fmap_for(OrderedDict)
 def _fmap_ordered_dict(func, o):
-    if func.__code__.co_argcount == 1:
+    if not _takes_pairs(func):
         func = on_values(func)
 
     fmapped = (func(k, v) for k, v in o.items())
@@ -146,21 +268,465 @@ def _fmap_ordered_dict(func, o):
 
 @fmap_for(ChainMap)
 def _fmap_chain_map(func, c):
-    if func.__code__.co_argcount == 1:
+    '''
+    Map over each layer's own items so that the layering (and shadowing)
+    of the original ChainMap is kept. Each layer keeps its own type if
+    fmap is defined for it and becomes a dict otherwise.
+    '''
+    if not _takes_pairs(func):
         func = on_values(func)
 
-    fmapped = []
-    for m in c.maps:
-        fmapped.append(dict(func(k, v) for k, v in c.items()))
-    return ChainMap(fmapped)
+    return ChainMap(*(_fmap_layer(func, m) for m in c.maps))
+
+
+def _fmap_layer(func, m):
+    if any(t in fmap.implementations for t in type(m).__mro__):
+        return fmap(func, m)
+    # e.g. MappingProxyType, os.environ or a user defined Mapping
+    return dict(func(k, v) for k, v in m.items())
 
 
 @fmap_for(defaultdict)
 def _fmap_default_dict(func, d):
-    if func.__code__.co_argcount == 1:
+    if not _takes_pairs(func):
         func = on_values(func)
 
     fmapped = (func(k, v) for k, v in d.items())
     new_d = defaultdict(d.default_factory)
     new_d.update(fmapped)
     return new_d
+
+
+###################################################################
+# In-place fmap: overwrite the elements of mutable containers     #
+# rather than building a new one.                                 #
+###################################################################
+@dispatch_on(index=1)
+def fmap_inplace(func, col):
+    '''
+    Map a function over the elements of a mutable container, replacing
+    each element with the result. col itself is returned.
+
+    Supported collection types:
+    ```````````````````````````
+    list, bytearray, array.array, deque, dict (and its subclasses)
+    - For dictionaries only the values can be mapped in place, so func
+      must take a single value.
+    '''
+    msg = ('fmap_inplace is not currently defined for {t}.\n To add a'
+           ' definition, use the @inplace_fmap_for({t}) decorator.')
+    raise TypeError(msg.format(t=type(col)))
+
+
+inplace_fmap_for = fmap_inplace.add
+
+
+@inplace_fmap_for(tuple)
+@inplace_fmap_for(str)
+@inplace_fmap_for(bytes)
+@inplace_fmap_for(frozenset)
+@inplace_fmap_for(range)
+def _fmap_inplace_immutable(func, col):
+    raise TypeError(
+        '{} is immutable so can not be fmapped in place: use fmap'
+        ' instead.'.format(type(col)))
+
+
+@inplace_fmap_for(list)
+@inplace_fmap_for(bytearray)
+@inplace_fmap_for(array)
+def _fmap_inplace_seq(func, s):
+    for i, element in enumerate(s):
+        s[i] = func(element)
+    return s
+
+
+@inplace_fmap_for(deque)
+def _fmap_inplace_deque(func, d):
+    # Indexing into the middle of a deque is O(n) so rotate through it.
+    # Replacing the head before rotating means nothing is lost if func
+    # raises and the deque can be rotated back into its original order.
+    for i in range(len(d)):
+        try:
+            d[0] = func(d[0])
+        except BaseException:
+            d.rotate(i)
+            raise
+        d.rotate(-1)
+    return d
+
+
+@inplace_fmap_for(dict)
+def _fmap_inplace_dict(func, d):
+    if isinstance(func, _OnValues):
+        func = func.func
+    if _takes_pairs(func):
+        raise TypeError(
+            'fmap_inplace can only map over dict values: changing keys'
+            ' requires building a new dict')
+    # Overwriting existing keys does not change the size of the dict so
+    # this is safe to do while iterating.
+    for key, value in d.items():
+        d[key] = func(value)
+    return d
+
+
+##################################################################
+# Lazy fmap: read-only views that call func on first access to   #
+# an index or key and cache the result.                          #
+##################################################################
+@dispatch_on(index=1)
+def fmap_lazy(func, col):
+    '''
+    Return a read-only view of fmap(func, col) that only applies func to
+    an element the first time it is accessed. Useful when only a few of
+    the results will ever be looked at.
+
+    Supported collection types:
+    ```````````````````````````
+    list, tuple (and other registered sequences) --> Sequence view
+    dict and its subclasses, ChainMap            --> Mapping view
+    - For a ChainMap only the visible (unshadowed) value for each key is
+      ever mapped.
+
+    NOTE: The view reads through to col so col should not be modified
+          while the view is in use. For dicts, only functions of a single
+          value are supported as keys must be known up front.
+    '''
+    msg = ('fmap_lazy is not currently defined for {t}.\n To add a'
+           ' definition, use the @lazy_fmap_for({t}) decorator.')
+    raise TypeError(msg.format(t=type(col)))
+
+
+lazy_fmap_for = fmap_lazy.add
+
+
+class _Unset:
+    '''Marker for a lazy view element that has not been computed.'''
+
+
+class FmapSequence(Sequence):
+    '''
+    Lazily mapped, memoising view over a sequence.
+    '''
+    __slots__ = 'func col cache'.split()
+
+    def __init__(self, func, col):
+        self.func = func
+        self.col = col
+        self.cache = {}
+
+    def __repr__(self):
+        return 'FmapSequence({!r}, {!r})'.format(self.func, self.col)
+
+    def __len__(self):
+        return len(self.col)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.col)))]
+
+        if index < 0:
+            index += len(self.col)
+        if not 0 <= index < len(self.col):
+            raise IndexError('FmapSequence index out of range')
+        value = self.cache.get(index, _Unset)
+        if value is _Unset:
+            value = self.cache[index] = self.func(self.col[index])
+        return value
+
+    def __iter__(self):
+        for i in range(len(self.col)):
+            yield self[i]
+
+
+class FmapMapping(Mapping):
+    '''
+    Lazily mapped, memoising view over the values of a mapping.
+    '''
+    __slots__ = 'func col cache'.split()
+
+    def __init__(self, func, col):
+        self.func = func
+        self.col = col
+        self.cache = {}
+
+    def __repr__(self):
+        return 'FmapMapping({!r}, {!r})'.format(self.func, self.col)
+
+    def __len__(self):
+        return len(self.col)
+
+    def __iter__(self):
+        return iter(self.col)
+
+    def __contains__(self, key):
+        return key in self.col
+
+    def __getitem__(self, key):
+        value = self.cache.get(key, _Unset)
+        if value is _Unset:
+            value = self.cache[key] = self.func(_lookup(self.col, key))
+        return value
+
+
+def _lookup(col, key):
+    '''
+    col[key] without falling back to __missing__ (e.g. for a defaultdict)
+    which would insert the key into col.
+    '''
+    if key not in col:
+        raise KeyError(key)
+    if isinstance(col, ChainMap):
+        # ChainMap tries every layer in turn, missing or not
+        for layer in col.maps:
+            if key in layer:
+                return _lookup(layer, key)
+    return col[key]
+
+
+@lazy_fmap_for(list)
+@lazy_fmap_for(tuple)
+def _lazy_view_seq(func, s):
+    return FmapSequence(func, s)
+
+
+@lazy_fmap_for(ChainMap)
+@lazy_fmap_for(dict)
+def _lazy_view_dict(func, d):
+    if isinstance(func, _OnValues):
+        func = func.func
+    if _takes_pairs(func):
+        raise TypeError(
+            'fmap_lazy can only map over dict values: keys must be known'
+            ' without calling func')
+    return FmapMapping(func, d)
+
+
+################################################################
+# Parallel fmap: reuses the fmap_for registry by running each  #
+# implementation once to collect the elements in order and     #
+# once more to place the results back into the same container. #
+################################################################
+def pfmap(func, col, executor=None, workers=None, chunksize=None,
+          threads=False):
+    '''
+    fmap func over col using a pool of workers. The elements are split
+    into chunks which are mapped on `executor` if one is given, otherwise
+    on a new ProcessPoolExecutor (or ThreadPoolExecutor if threads=True)
+    with `workers` workers that is shut down before returning.
+
+    The result is the same as fmap(func, col): sequences keep their order
+    and the dict family keep their key layout. Any type registered with
+    fmap_for will work so long as its implementation calls func once per
+    element in a repeatable order.
+
+    NOTE: When using processes, func and the elements must be picklable.
+    '''
+    if isinstance(col, Iterator):
+        # Can't be iterated twice so the best we can do is map it eagerly
+        return iter(_parallel_map(
+            func, list(col), False, executor, workers, chunksize, threads))
+
+    elements, pairs = _collect(func, col)
+    results = _parallel_map(
+        func, elements, pairs, executor, workers, chunksize, threads)
+    return _rebuild(col, results, pairs)
+
+
+def _collect(func, col):
+    '''
+    Run the fmap implementation for col to find the elements (or key,
+    value pairs) that func would be called with, in the order it would be
+    called with them.
+    '''
+    elements = []
+    pairs = _takes_pairs(func)
+
+    if pairs:
+        def collect(key, value):
+            elements.append((key, value))
+            return key, value
+    else:
+        def collect(element):
+            elements.append(element)
+            return element
+
+    collected = fmap(collect, col)
+    if isinstance(collected, Iterator):
+        # Lazy implementations need driving to see the elements
+        deque(collected, maxlen=0)
+
+    return elements, pairs
+
+
+def _rebuild(col, results, pairs):
+    '''
+    Run the fmap implementation for col again, substituting the results
+    (in order) for the calls to func.
+    '''
+    results = iter(results)
+
+    if pairs:
+        def replay(key, value):
+            return next(results)
+    else:
+        def replay(element):
+            return next(results)
+
+    return fmap(replay, col)
+
+
+def _takes_pairs(func):
+    '''
+    Functions of two arguments are applied to (key, value) pairs.
+    '''
+    if isinstance(func, (_OnKeys, _OnValues)):
+        return True
+    code = getattr(func, '__code__', None)
+    return code is not None and code.co_argcount == 2
+
+
+def _map_chunk(func, chunk):
+    return [func(element) for element in chunk]
+
+
+def _starmap_chunk(func, chunk):
+    return [func(*pair) for pair in chunk]
+
+
+def _parallel_map(func, elements, pairs, executor, workers, chunksize,
+                  threads):
+    '''
+    Map func over elements in chunks on an executor, preserving order.
+    '''
+    if not elements:
+        return []
+
+    if executor is None:
+        pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+        with pool(max_workers=workers) as executor:
+            return _parallel_map(
+                func, elements, pairs, executor, workers, chunksize, threads)
+
+    if chunksize is None:
+        # A few chunks per worker to smooth out uneven workloads
+        n_chunks = 4 * (workers or getattr(executor, '_max_workers', 1))
+        chunksize = max(1, -(-len(elements) // n_chunks))
+
+    chunks = [elements[i:i + chunksize]
+              for i in range(0, len(elements), chunksize)]
+    mapper = _starmap_chunk if pairs else _map_chunk
+    return list(chain.from_iterable(
+        executor.map(mapper, repeat(func), chunks)))
+
+
+###############################################################
+# Async fmap: coroutine functions are run concurrently, up to  #
+# a limit, and the results placed back into the same container #
+# using the same approach as pfmap.                            #
+###############################################################
+def afmap(func, col, limit=None):
+    '''
+    fmap a coroutine function (or a plain function) over col, running up
+    to `limit` calls concurrently (no limit if None).
+
+    For anything fmap supports this returns a coroutine that evaluates to
+    the same container type that fmap would give:
+        await afmap(fetch, urls)
+
+    For an async iterator this returns an async generator that streams the
+    results out in order:
+        async for result in afmap(fetch, stream, limit=10):
+            ...
+    '''
+    if hasattr(col, '__aiter__'):
+        return _afmap_stream(func, col, limit)
+    return _afmap_col(func, col, limit)
+
+
+async def _acall(func, args):
+    result = func(*args)
+    if isawaitable(result):
+        result = await result
+    return result
+
+
+async def _afmap_col(func, col, limit):
+    if isinstance(col, Iterator):
+        # Can't be iterated twice so the best we can do is map it eagerly
+        elements, pairs = list(col), False
+    else:
+        elements, pairs = _collect(func, col)
+
+    calls = [e if pairs else (e,) for e in elements]
+    results = [None] * len(calls)
+    todo = iter(range(len(calls)))
+
+    async def worker():
+        # Workers share the iterator of indices so we only ever have
+        # `limit` calls in flight and `limit` tasks in total.
+        for i in todo:
+            results[i] = await _acall(func, calls[i])
+
+    n_workers = min(limit or len(calls), len(calls))
+    workers = [asyncio.ensure_future(worker()) for _ in range(n_workers)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # If a call failed (or we were cancelled) don't leave the other
+        # workers making calls in the background.
+        for task in workers:
+            task.cancel()
+
+    if isinstance(col, Iterator):
+        return iter(results)
+    return _rebuild(col, results, pairs)
+
+
+async def _afmap_stream(func, stream, limit):
+    pending = deque()
+
+    try:
+        async for element in stream:
+            if limit and len(pending) >= limit:
+                yield await pending.popleft()
+            pending.append(asyncio.ensure_future(_acall(func, (element,))))
+            # Stream out anything that is already done without waiting
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+
+        while pending:
+            yield await pending.popleft()
+    finally:
+        # Stopping early (or a failed call) cancels everything in flight
+        for task in pending:
+            task.cancel()
+
+
+##########################################################
+# Optional implementations for third party array types:  #
+# these need to be explicitly registered before use.     #
+##########################################################
+def register_ndarray(vectorised=False):
+    '''
+    Register an fmap implementation for numpy.ndarray.
+    (numpy is not a dependency of concepts so this is opt-in.)
+
+    ufuncs and np.vectorize objects are applied to the whole array in a
+    single call and everything else is applied element-wise. Pass
+    vectorised=True if every function you fmap over arrays works
+    element-wise on a whole array to always use a single call.
+    '''
+    import numpy as np
+
+    @fmap_for(np.ndarray)
+    def _fmap_ndarray(func, a):
+        if vectorised or isinstance(func, (np.ufunc, np.vectorize)):
+            return func(a)
+
+        if a.size == 0:
+            return a.copy()
+        return np.array([func(x) for x in a.flat]).reshape(a.shape)
+
+    return _fmap_ndarray
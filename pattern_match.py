@@ -1,12 +1,25 @@
+import ast
+import builtins
 from copy import copy
-from sys import _getframe
-from functools import wraps
+from time import perf_counter
+from sys import _getframe, version_info
+from functools import wraps, lru_cache
 from collections import Container
 from inspect import getfullargspec
 from contextlib import contextmanager
 from types import CodeType, FunctionType
 from ctypes import c_int, pythonapi, py_object
-from itertools import chain, zip_longest, takewhile
+from itertools import chain, islice
+from keyword import iskeyword
+
+from .recompile import recompile
+
+
+# Maximum number of distinct compiled patterns to keep
+PATTERN_CACHE_SIZE = 1024
+# Targets that are matched as they are. Anything else (e.g. a deque, which
+# is a Sequence that can't be sliced) is converted to a list first.
+SLICEABLE = (list, tuple, range)
 
 
 @contextmanager
@@ -42,7 +55,24 @@ def pattern_matching(func):
           `_args` as that is the only identifier we have to work with.
           (If you prefer to use something like *spam then it will correctly
            bind _spam instead.)
+
+    func is rewritten from its source once, at decoration time, so that
+    the match objects and pattern variables are fast locals of the
+    function itself. This needs the source of func and can't be done for
+    closures or functions that wrap another function: a TypeError is
+    raised for those. (Before Python 3.6 they fall back to supplying the
+    match objects through a copy of the function's globals on every call.)
     '''
+    with_locals = _with_local_matchers(func)
+    if with_locals is not None:
+        return with_locals
+
+    if version_info >= (3, 6):
+        # The bytecode rewriting below relies on the pre-3.6 format
+        raise TypeError(
+            'pattern_matching needs the source of {} and can not be used on'
+            ' closures or wrapped functions'.format(func.__qualname__))
+
     def global_to_fast(func):
         '''
         Swap global lookups for local ones for pattern variables and
@@ -134,94 +164,137 @@ def pattern_matching(func):
     return wrapped
 
 
+def _with_local_matchers(func):
+    '''
+    Recompile func from its source with a Match_object for each argument
+    created at the top of the function body and every pattern variable
+    declared as a local. Returns None if func can not be rewritten.
+    '''
+    spec = getfullargspec(func)
+
+    def add_matchers(fdef):
+        named = spec.args + spec.kwonlyargs
+        assigned = {
+            n.id for n in ast.walk(fdef)
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+
+        setup = ['_{0} = _Match_object({0}, decorated=True)'.format(arg)
+                 for arg in named]
+        if spec.varargs:
+            setup.append('_{0} = _Match_object({0}, decorated=True)'.format(
+                spec.varargs))
+        if spec.varkw:
+            setup.append('_{0} = _Match_object({0}, decorated=True)'.format(
+                spec.varkw))
+        matchers = {'_' + arg for arg in named + [spec.varargs, spec.varkw]
+                    if arg}
+
+        if spec.varkw:
+            # Individual keyword arguments are only known by name from
+            # their use. Anything that is already a global (e.g. a module
+            # helper function) is left alone and names that are not defined
+            # yet still fall back to the globals when no keyword argument is
+            # passed.
+            loaded = {
+                n.id for n in ast.walk(fdef)
+                if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)}
+            keywords = sorted(
+                name for name in loaded
+                if name.startswith('_') and name[1:].isidentifier()
+                and name[1:] not in named and name not in assigned
+                and name not in func.__globals__
+                and not hasattr(builtins, name))
+            setup.extend(
+                'if {0!r} in {1}: _{0} = _Match_object({1}[{0!r}], '
+                'decorated=True)\n'
+                'elif {2!r} in _globals: _{0} = _globals[{2!r}]'.format(
+                    name[1:], spec.varkw, name)
+                for name in keywords)
+            matchers.update(keywords)
+
+        # Assigning to the pattern variables anywhere in the function
+        # makes them locals that the match can then be bound to. Only
+        # templates matched against a match object count: `_a >= '(x y)'`
+        pvars = set()
+        for node in ast.walk(fdef):
+            if isinstance(node, ast.Compare) and len(node.ops) == 1 and \
+                    isinstance(node.ops[0], ast.GtE):
+                left, right = node.left, node.comparators[0]
+            elif isinstance(node, ast.BinOp) and \
+                    isinstance(node.op, ast.RShift):
+                left, right = node.left, node.right
+            else:
+                continue
+            # String literals are ast.Str before Python 3.8
+            value = getattr(right, 'value', getattr(right, 's', None))
+            if isinstance(left, ast.Name) and left.id in matchers and \
+                    isinstance(value, str):
+                try:
+                    pvars.update(compile_pattern(value).template.symbols)
+                except SyntaxError:
+                    pass
+        pvars -= set(named) | {spec.varargs, spec.varkw}
+        if pvars:
+            setup.append(
+                'if False: {} = None'.format(' = '.join(sorted(pvars))))
+
+        fdef.body[:0] = ast.parse('\n'.join(setup)).body
+
+    return recompile(func, add_matchers, _Match_object=Match_object,
+                     _globals=func.__globals__)
+
+
+# Results of non_string_collection for each type seen so far. Checking
+# against the Container ABC is comparatively slow and this is done for
+# every element of a target.
+_collection_types = {}
+
+
 def non_string_collection(x):
     '''
     A simple helper to allow string types to be
     distinguished from other collection types.
     '''
-    if isinstance(x, Container):
-        if not isinstance(x, (str, bytes)):
-            return True
-    return False
+    try:
+        return _collection_types[type(x)]
+    except KeyError:
+        result = isinstance(x, Container) and not isinstance(x, (str, bytes))
+        _collection_types[type(x)] = result
+        return result
 
 
 class Pvar:
     '''
     Internal representation of pattern variables.
-    Pattern variables maintain
+    Pattern variables are immutable once created: the values they match
+    are stored in the bindings dict for each individual match.
     '''
-    __slots__ = 'greedy greedy_expanded symbol value'.split()
+    __slots__ = 'greedy symbol'.split()
     repeating = False
 
     def __init__(self, symbol, greedy=False):
-        self.symbol = symbol
+        self.symbol = symbol.lstrip('*') if greedy else symbol
         self.greedy = greedy
-        if self.greedy:
-            self.symbol = self.symbol.lstrip('*')
-            self.greedy_expanded = False
-        self.value = None
 
     def __repr__(self):
-        return '{} -> {}'.format(self.symbol, self.value)
-
-    def __eq__(self, other):
-        '''
-        Compare and bind a value to the pattern variable
-        '''
-        if self.symbol == '_':
-            # Underscores match anything
-            self.value = 'Matched'
-            return True
-        else:
-            if non_string_collection(other):
-                # Pvars can not match a sub-template
-                return False
-            elif self.greedy:
-                if self.value:
-                    # Greedy pattern variables grow
-                    self.value.append(other)
-                    return True
-                else:
-                    # Greedy variables always return a list
-                    self.value = [other]
-                    return True
-            else:
-                self.value = other
-                return True
-
-    def _propagate_match(self, attempt):
-        '''
-        Make sure repeated variables have the same value.
-        '''
-        if self.symbol == '_':
-            # Don't store values matched against underscores.
-            pass
-        else:
-            existing = attempt.get(self.symbol)
-
-            if existing:
-                # This variable is used more than once in the pattern.
-                # It must have the same value each time for the match
-                # to succeed.
-                if self.value != existing:
-                    raise ValueError('FAILED MATCH')
-            else:
-                # There are no conflicts so update the match
-                attempt[self.symbol] = self.value
+        return '*' + self.symbol if self.greedy else self.symbol
 
 
 class Template:
     '''
     Specification for the match.
+
+    A template is split into a fixed `head` and `tail` with at most two
+    variable length elements (one greedy variable and one repeating
+    sub-template) in between, separated by the fixed `middle` elements.
     '''
-    __slots__ = 'repeating pvars value map'.split()
+    __slots__ = ('repeating pvars head variable middle tail '
+                 'min_length symbols').split()
     greedy = False
 
     def __init__(self, match_template):
-        self.pvars = []
-        self.map = dict()
+        pvars = []
         self.repeating = False
-        self.value = None
 
         has_star = False
         has_ellipsis = False
@@ -231,7 +304,7 @@ class Template:
 
             if non_string_collection(element):
                 # Add a sub-template
-                self.pvars.append(Template(element))
+                pvars.append(Template(element))
             else:
                 # Tag greedy pattern variables
                 if element.startswith('*'):
@@ -244,7 +317,7 @@ class Template:
 
                 if element == '...':
                     # Ellipsis makes the previous sub-template greedy
-                    if not isinstance(self.pvars[-1], Template):
+                    if not pvars or not isinstance(pvars[-1], Template):
                         raise SyntaxError(
                             '... can only be used on a repeating sub template')
                     if has_ellipsis:
@@ -252,119 +325,626 @@ class Template:
                             'Can only have a maximum of one ... per template')
                     else:
                         has_ellipsis = True
-                        self.pvars[-1].repeating = True
+                        pvars[-1].repeating = True
                 else:
-                    self.pvars.append(Pvar(element, greedy=next_var_is_greedy))
+                    pvars.append(Pvar(element, greedy=next_var_is_greedy))
+
+        self.pvars = tuple(pvars)
+        variable = [i for i, p in enumerate(pvars) if p.greedy or p.repeating]
+        self.variable = tuple(pvars[i] for i in variable)
+        if variable:
+            self.head = self.pvars[:variable[0]]
+            self.middle = self.pvars[variable[0] + 1:variable[-1]]
+            self.tail = self.pvars[variable[-1] + 1:]
+        else:
+            self.head, self.middle, self.tail = self.pvars, (), ()
+        self.min_length = len(pvars) - len(variable)
 
-    def __eq__(self, other):
-        if not non_string_collection(other):
-            # Convert to a single element list so that we don't accidentally
-            # split strings into their characters
-            other = [other]
-
-        pairs = list(zip_longest(self.pvars, other, fillvalue=None))
-        try:
-            return self.compare_and_bind(pairs)
-        except ValueError as e:
-            if e.args[0] == 'FAILED MATCH':
-                return False
-            else:
-                raise
-
-    def compare_and_bind(self, pairs):
-        for _ in range(len(pairs)):
-            pvar, target = pairs.pop(0)
-            if pvar is None:  # target is longer than the template
-                return False
-
-            self.check_match(pvar, target)
-
-            if pvar.greedy and not pvar.greedy_expanded:
-                self.match_greedy(pvar, pairs)
-                break
-            elif pvar.repeating:
-                self.match_repeating(pvar, pairs)
-                break
-
-        if all([v.value for v in self.pvars]):
-            self.value = self.pvars
-            return True
+        symbols = []
+        for pvar in pvars:
+            new = pvar.symbols if isinstance(pvar, Template) else [pvar.symbol]
+            symbols.extend(s for s in new if s != '_' and s not in symbols)
+        self.symbols = tuple(symbols)
+
+    def __repr__(self):
+        return '({}){}'.format(
+            ' '.join(map(repr, self.pvars)), ' ...' if self.repeating else '')
+
+
+class Matcher:
+    '''
+    A compiled pattern: `match(target)` returns a dict of the values bound
+    to each pattern variable or None if target does not match.
+    '''
+    __slots__ = 'pattern template _match source prefix record'.split()
+
+    def __init__(self, pattern, template):
+        self.pattern = pattern
+        self.template = template
+        self._match, self.source = TemplateCompiler().compile(template)
+        # Matcher for the fixed head of the template, see match_stream
+        self.prefix = None
+        # Slotted class for the bindings, see match_all
+        self.record = None
+
+    def __repr__(self):
+        return 'Matcher({!r})'.format(self.pattern)
+
+    def match(self, target):
+        '''
+        Return a dict of the values bound to each pattern variable if
+        target matches or None if it doesn't.
+        '''
+        if _observing:
+            return _observed(self, target, self._match)
+        return self._match(target)
+
+    def match_all(self, targets, records=False):
+        '''
+        Lazily match each of targets in turn, yielding the bindings for
+        those that match. If records is True then each set of bindings is
+        given as an instance of a slotted class with an attribute for each
+        pattern variable rather than as a dict.
+        '''
+        match = self._match
+        if _observing:
+            def match(target, match=match):
+                return _observed(self, target, match)
+
+        if records:
+            if self.record is None:
+                self.record = _record_type(self.template.symbols)
+            make = self.record
+            for target in targets:
+                bindings = match(target)
+                if bindings is not None:
+                    yield make(bindings)
         else:
-            return False
+            for target in targets:
+                bindings = match(target)
+                if bindings is not None:
+                    yield bindings
 
-    def match_greedy(self, pvar, pairs):
+    def match_stream(self, iterable):
         '''
-        Deal with a greedy variable in the middle of a pattern by
-        caching any later pattern variables as we match and then adding
-        them back after expanding the greedy variable to fill the gap.
+        Match against an iterator (or any iterable) pulling only as many
+        elements as are needed to decide the match.
+
+        If the template ends with a greedy variable - i.e. '(a b *rest)' -
+        then only the elements before it are consumed and the greedy
+        variable is bound to the remaining (lazy) iterator. In that case
+        the remaining elements are not checked for being sub-collections.
+        Fixed length templates consume at most one element more than
+        their length. Anything else needs the whole stream.
         '''
-        cached = []
-        try:
-            next_pvar, next_target = pairs.pop(0)
-        except IndexError:
-            raise ValueError('FAILED MATCH')
-
-        for _ in range(len(pairs)):
-            if next_pvar is None or non_string_collection(next_target):
-                break
-            cached.append(next_pvar)
-            self.check_match(pvar, next_target)
-            try:
-                next_pvar, next_target = pairs.pop(0)
-            except IndexError:
-                # End of the list
-                break
-
-        # Everything else is unmatched:
-        # --> match the last one from the while loop first
-        self.check_match(pvar, next_target)
-        rem = len(list(takewhile(non_string_collection, pairs)))
-        if rem:
-            v, t = pairs.pop(0)
-            self.check_match(pvar, t)
-        diff = len(pairs) - len(cached) * rem
-        pvar.greedy_expanded = True
-        left_over_pvars = diff * [pvar] + cached
-        left_over_targets = [r[1] for r in pairs]
-        new_pairs = list(zip_longest(left_over_pvars, left_over_targets))
-        self.compare_and_bind(new_pairs)
-
-    def match_repeating(self, pvar, pairs):
+        if _observing:
+            return _observed(self, iterable, self._match_stream)
+        return self._match_stream(iterable)
+
+    def _match_stream(self, iterable):
+        template = self.template
+        stream = iter(iterable)
+        head = list(islice(stream, len(template.head)))
+        if len(head) < len(template.head):
+            return None
+
+        if not template.variable:
+            if next(stream, _END) is not _END:
+                # Too long
+                return None
+            return self._match(head)
+
+        greedy = template.variable[0]
+        if len(template.variable) > 1 or template.tail or not greedy.greedy:
+            # We need to see everything
+            return self._match(head + list(stream))
+
+        if not head:
+            bindings = {}
+        else:
+            if self.prefix is None:
+                self.prefix = compile_pattern(
+                    '({})'.format(' '.join(map(repr, template.head))))
+            if greedy.symbol in self.prefix.template.symbols:
+                # Repeated variables need the whole stream to compare
+                return self._match(head + list(stream))
+            bindings = self.prefix._match(head)
+
+        if bindings is not None and greedy.symbol != '_':
+            bindings[greedy.symbol] = stream
+        return bindings
+
+
+def _record_type(symbols):
+    '''
+    Create a lightweight class for holding the bindings of a match.
+    '''
+    if not all(symbol.isidentifier() and not iskeyword(symbol)
+               for symbol in symbols):
+        raise ValueError(
+            'Pattern variables must be valid identifiers to use records')
+
+    init = ['def __init__(self, b):']
+    init.extend('    self.{0} = b[{0!r}]'.format(s) for s in symbols)
+    init.append('    pass')
+    namespace = {}
+    exec('\n'.join(init), namespace)
+
+    def __repr__(self):
+        return 'Bindings({})'.format(', '.join(
+            '{}={!r}'.format(s, getattr(self, s)) for s in symbols))
+
+    return type('Bindings', (), {
+        '__slots__': symbols,
+        '__init__': namespace['__init__'],
+        '__repr__': __repr__,
+    })
+
+
+# Marks the end of a stream in Matcher.match_stream
+_END = object()
+
+
+# Entry point for the functions generated by TemplateCompiler
+_MATCH_SOURCE = '''
+def match(target):
+    b = {{}}
+    return b if {root}(target, b) else None
+'''
+
+
+class TemplateCompiler:
+    '''
+    Generate a specialised Python function for matching a Template.
+
+    Each (sub-)template becomes a function `_m<n>(t, b)` that binds into
+    the dict `b` and returns a bool. Length checks, element checks and
+    binding are all straight-line code and, as the order in which pattern
+    variables are bound is known up front, repeated variables turn into
+    a simple equality check against the earlier binding.
+    '''
+    def __init__(self):
+        self.functions = []
+
+    def compile(self, template):
+        root = self.node(template, set())
+        source = '\n'.join(self.functions + [_MATCH_SOURCE.format(root=root)])
+        namespace = {'_coll': non_string_collection, '_sliceable': SLICEABLE}
+        exec(source, namespace)
+        return namespace['match'], source
+
+    def node(self, template, bound):
         '''
-        Handle a repeating sub-template.
-        Variables in sub-templates return a list of all values that
-        matched that position in the template.
+        Generate the function for a template, returning its name. `bound`
+        is the set of symbols that are already bound when it is called and
+        is updated with everything that it binds.
         '''
-        values_so_far = {k: [v] for k, v in pvar.map.items()}
-        for _, next_target in pairs:
-            # Reset the sub-template match so we can go again
-            # This gets transferred to the primary template.
-            pvar.map = {}
-            for p in pvar.pvars:
-                p.value = None
-            self.check_match(pvar, next_target)
-            # update the map
-            for p in pvar.pvars:
-                new = values_so_far.setdefault(p.symbol, [])
-                new.append(p.value)
-        # We've now drained pairs so we are done
-        self.map.update(values_so_far)
-
-    def check_match(self, pvar, target):
+        name = '_m{}'.format(len(self.functions))
+        # Reserve our place: sub-templates are generated as we go
+        self.functions.append(None)
+
+        lines = [
+            'if not _coll(t):',
+            '    t = (t,)',
+            'elif not isinstance(t, _sliceable):',
+            '    t = list(t)',
+            'n = len(t)',
+            'if n {} {}:'.format(
+                '<' if template.variable else '!=', template.min_length),
+            '    return False',
+        ]
+
+        k = len(template.tail)
+        for i, pvar in enumerate(template.head):
+            self.element(pvar, 't[{}]'.format(i), bound, lines)
+        for i, pvar in enumerate(template.tail):
+            self.element(pvar, 't[n - {}]'.format(k - i), bound, lines)
+
+        h = len(template.head)
+        stop = 'n - {}'.format(k) if k else 'n'
+        if len(template.variable) == 1:
+            self.variable(template.variable[0], str(h), stop, bound, lines)
+        elif template.variable:
+            # The first variable length element takes as much as it can
+            # while leaving room for the middle section.
+            first, second = template.variable
+            m = len(template.middle)
+            lines.append('e = {}'.format(h))
+            if first.greedy:
+                # A greedy variable runs up to the first sub-collection and
+                # then gives the middle section back.
+                self.variable(first, str(h), stop, bound, lines,
+                              partial=True, leave=m)
+            else:
+                self.variable(first, str(h), '{} - {}'.format(stop, m),
+                              bound, lines, partial=True)
+            for i, pvar in enumerate(template.middle):
+                index = 't[e + {}]'.format(i) if i else 't[e]'
+                self.element(pvar, index, bound, lines)
+            self.variable(second, 'e + {}'.format(m), stop, bound, lines)
+
+        lines.append('return True')
+        self.functions[int(name[2:])] = 'def {}(t, b):\n{}\n'.format(
+            name, '\n'.join('    ' + line for line in lines))
+        return name
+
+    def element(self, pvar, index, bound, lines):
         '''
-        Check for a match and update the current mapping
-        This works for Pvars and Templates.
+        Match a single element of the target.
         '''
-        if pvar == target:
-            if isinstance(pvar, Template):
-                if pvar.repeating:
-                    for k, v in pvar.map.items():
-                        new = self.map.setdefault(k, [])
-                        new.append(v)
-                else:
-                    self.map.update(pvar.map)
+        if isinstance(pvar, Template):
+            lines.append('if not {}({}, b):'.format(
+                self.node(pvar, bound), index))
+            lines.append('    return False')
+        elif pvar.symbol != '_':
+            lines.extend([
+                'x = {}'.format(index),
+                # Pvars can not match a sub-template
+                'if _coll(x):',
+                '    return False',
+            ])
+            self.assign(pvar.symbol, 'x', bound, lines)
+
+    def variable(self, pvar, start, stop, bound, lines, partial=False,
+                 leave=0):
+        '''
+        Match a greedy variable or repeating sub-template against
+        t[start:stop]. If partial, it stops at the first element that does
+        not match and leaves the index it got to in `e`, otherwise all of
+        the elements must match. A partial greedy variable then steps back
+        `leave` elements so that they are left for what follows it.
+        '''
+        if pvar.greedy:
+            # Greedy variables consume everything up to a sub-collection
+            if partial:
+                lines.extend([
+                    'while e < {} and not _coll(t[e]):'.format(stop),
+                    '    e += 1',
+                ])
+                if leave:
+                    lines.extend([
+                        'e -= {}'.format(leave),
+                        'if e < {}:'.format(start),
+                        '    return False',
+                    ])
+                lines.append('v = t[{}:e]'.format(start))
+            else:
+                lines.extend([
+                    'v = t[{}:{}]'.format(start, stop),
+                    'for x in v:',
+                    '    if _coll(x):',
+                    '        return False',
+                ])
+            if pvar.symbol != '_':
+                # Slicing a list already gives us a new list
+                lines.extend([
+                    'if v.__class__ is not list:',
+                    '    v = list(v)',
+                ])
+                self.assign(pvar.symbol, 'v', bound, lines)
+            return
+
+        # Variables in repeating sub-templates collect a list of all values
+        # that matched that position in the template.
+        name = self.node(pvar, set())
+        accumulators = ['r{}'.format(i) for i in range(len(pvar.symbols))]
+        lines.extend('{} = []'.format(r) for r in accumulators)
+        if partial:
+            lines.extend([
+                'while e < {}:'.format(stop),
+                '    a = {}',
+                '    if not {}(t[e], a):'.format(name),
+                '        break',
+            ])
+        else:
+            lines.extend([
+                'for i in range({}, {}):'.format(start, stop),
+                '    a = {}',
+                '    if not {}(t[i], a):'.format(name),
+                '        return False',
+            ])
+        for r, symbol in zip(accumulators, pvar.symbols):
+            lines.append('    {}.append(a[{!r}])'.format(r, symbol))
+        if partial:
+            lines.append('    e += 1')
+        for r, symbol in zip(accumulators, pvar.symbols):
+            self.assign(symbol, r, bound, lines)
+
+    def assign(self, symbol, value, bound, lines):
+        '''
+        Bind a value to a pattern variable, making sure that repeated
+        variables have the same value each time.
+        '''
+        if symbol in bound:
+            lines.append('if b[{!r}] != {}:'.format(symbol, value))
+            lines.append('    return False')
+        else:
+            bound.add(symbol)
+            lines.append('b[{!r}] = {}'.format(symbol, value))
+
+
+def parse(tokens):
+    '''
+    Convert a string representation of the template to
+    a - potentially nested - tuple that we can iterate over.
+    '''
+    tokens = iter(tokens)
+    for t in tokens:
+        if t == '(':
+            group = []
+            t = next(tokens, None)
+            if t == ')':
+                raise SyntaxError('Empty match template')
             else:
-                pvar._propagate_match(self.map)
+                while t != ')':
+                    if t is None:
+                        raise SyntaxError('Unbalanced parens in template')
+                    tokens = chain([t], tokens)
+                    group.append(next(parse(tokens)))
+                    t = next(tokens, None)
+                yield tuple(group)
+        else:
+            yield t
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern_str):
+    '''
+    Parse a pattern string and compile it into an immutable Matcher that
+    can be used to match any number of targets.
+
+    Compiled patterns are kept in a bounded LRU cache keyed on the pattern
+    string so each distinct pattern is only parsed once. Use
+    compile_pattern.cache_info() for hit and miss statistics and
+    compile_pattern.cache_clear() to empty the cache.
+    '''
+    if not _observing:
+        return _compile(pattern_str)
+
+    start = perf_counter()
+    matcher = _compile(pattern_str)
+    if _stats is not None:
+        stats = _stats_for(pattern_str)
+        stats[0] += 1
+        stats[3] += perf_counter() - start
+    return matcher
+
+
+def _compile(pattern_str):
+    tokens = pattern_str.replace('(', ' ( ').replace(')', ' ) ').split()
+    pattern = next(parse(tokens), None)
+    if not isinstance(pattern, tuple):
+        raise SyntaxError('A template must start and stop with parens')
+    return Matcher(pattern_str, Template(pattern))
+
+
+############################################################
+# Instrumentation: opt-in per pattern statistics and a     #
+# debug trace hook. When neither is enabled the only cost  #
+# is checking the `_observing` flag.                       #
+############################################################
+# [compiles, matches, misses, parse time, match time] for each pattern
+_stats = None
+_trace = None
+_observing = False
+
+
+def instrument_patterns(enabled=True):
+    '''
+    Turn per pattern statistics on or off. Enabling them discards
+    anything that was previously recorded.
+    NOTE: Patterns that are already in the compile_pattern cache will not
+          be recompiled so use compile_pattern.cache_clear() as well if
+          you want to count compiles from scratch.
+    '''
+    global _stats, _observing
+    _stats = {} if enabled else None
+    _observing = _stats is not None or _trace is not None
+
+
+def set_pattern_trace(hook=None):
+    '''
+    Call hook(pattern_str, target, bindings) after every match attempt.
+    bindings is None for a failed match. Pass None to remove the hook.
+    '''
+    global _trace, _observing
+    _trace = hook
+    _observing = _stats is not None or _trace is not None
+
+
+def pattern_metrics():
+    '''
+    Snapshot of the recorded statistics for each pattern: the number of
+    compiles, matches and misses along with the time spent parsing
+    (compiling) and matching.
+    '''
+    return {
+        pattern: {'compiles': compiles, 'matches': matches,
+                  'misses': misses, 'parse_time': parse_time,
+                  'match_time': match_time}
+        for pattern, (compiles, matches, misses, parse_time, match_time)
+        in (_stats or {}).items()
+    }
+
+
+def _stats_for(pattern_str):
+    return _stats.setdefault(pattern_str, [0, 0, 0, 0.0, 0.0])
+
+
+def _observed(matcher, target, match):
+    '''
+    Run match(target) for a matcher, recording the result.
+    '''
+    start = perf_counter()
+    bindings = match(target)
+    elapsed = perf_counter() - start
+
+    if _stats is not None:
+        stats = _stats_for(matcher.pattern)
+        stats[1 if bindings is not None else 2] += 1
+        stats[4] += elapsed
+    if _trace is not None:
+        _trace(matcher.pattern, target, bindings)
+    return bindings
+
+
+def match_stream(pattern_str, iterable):
+    '''
+    Match a pattern against an iterator, only consuming as much of it as
+    the pattern needs. (See Matcher.match_stream)
+    '''
+    return compile_pattern(pattern_str).match_stream(iterable)
+
+
+def match_all(pattern_str, targets, records=False):
+    '''
+    Match a pattern against each of targets, yielding the bindings for
+    those that match. (See Matcher.match_all)
+    '''
+    return compile_pattern(pattern_str).match_all(targets, records)
+
+
+class MatchTable:
+    '''
+    An ordered set of (pattern, handler) clauses. Calling the table with a
+    target runs the handler for the first pattern that matches, passing
+    the bound pattern variables as keyword arguments:
+
+        describe = MatchTable([
+            ('(a)',       lambda a: 'one thing'),
+            ('(a b)',     lambda a, b: 'a pair'),
+            ('(a *rest)', lambda a, rest: 'a and more'),
+        ], default=lambda: 'nothing')
+
+    Rather than trying each pattern in turn, the clauses are compiled into
+    a decision tree that first switches on the length of the target and
+    then on which positions hold sub-collections. Only the clauses that
+    are left at the leaf of the tree are fully matched.
+
+    If no clause matches, `default` is called with no arguments or a
+    ValueError is raised if there is no default.
+    '''
+    __slots__ = 'clauses matchers default by_length long max_fixed'.split()
+
+    def __init__(self, clauses, default=None):
+        self.clauses = tuple(clauses)
+        self.matchers = tuple(compile_pattern(p) for p, _ in self.clauses)
+        self.default = default
+
+        templates = [m.template for m in self.matchers]
+        # Targets longer than this can only match variable length patterns
+        self.max_fixed = max((t.min_length for t in templates), default=0)
+        self.by_length = [
+            _decide(range(len(templates)), {
+                i: _shape(t, length) for i, t in enumerate(templates)
+                if _can_match_length(t, length)})
+            for length in range(self.max_fixed + 1)
+        ]
+        self.long = _decide(range(len(templates)), {
+            i: _shape(t) for i, t in enumerate(templates) if t.variable})
+
+    def __repr__(self):
+        return 'MatchTable({!r})'.format([p for p, _ in self.clauses])
+
+    def __call__(self, target):
+        if not non_string_collection(target):
+            target = (target,)
+        elif not isinstance(target, SLICEABLE):
+            target = list(target)
+
+        n = len(target)
+        node = self.by_length[n] if n <= self.max_fixed else self.long
+        while node.__class__ is _Decision:
+            if non_string_collection(target[node.position]):
+                node = node.collection
+            else:
+                node = node.scalar
+
+        for i in node:
+            matcher = self.matchers[i]
+            if _observing:
+                bindings = _observed(matcher, target, matcher._match)
+            else:
+                bindings = matcher._match(target)
+            if bindings is not None:
+                return self.clauses[i][1](**bindings)
+
+        if self.default is None:
+            raise ValueError('No clause matched {!r}'.format(target))
+        return self.default()
+
+
+class _Decision:
+    '''
+    A branch in a MatchTable decision tree.
+    '''
+    __slots__ = 'position collection scalar'.split()
+
+    def __init__(self, position, collection, scalar):
+        self.position = position
+        self.collection = collection
+        self.scalar = scalar
+
+
+def _can_match_length(template, n):
+    if template.variable:
+        return n >= template.min_length
+    return n == template.min_length
+
+
+def _requirement(pvar):
+    '''
+    Whether an element matching pvar must be a sub-collection (True), must
+    not be one (False) or could be either (None).
+    '''
+    if isinstance(pvar, Template):
+        # Sub-templates will wrap a non-collection in a single element list
+        return None if _can_match_length(pvar, 1) else True
+    return None if pvar.symbol == '_' else False
+
+
+def _shape(template, n=None):
+    '''
+    The positions in a target of length n that have a requirement. If n is
+    not known then positions in the tail are given as negative indices.
+    '''
+    k = len(template.tail)
+    positions = list(enumerate(template.head))
+    positions.extend(
+        (i - k if n is None else n - k + i, pvar)
+        for i, pvar in enumerate(template.tail))
+    return {i: _requirement(pvar) for i, pvar in positions
+            if _requirement(pvar) is not None}
+
+
+def _decide(order, shapes):
+    '''
+    Build a decision tree over the clauses in `shapes`. Leaves are tuples
+    of the clause indices (in their original order) that still need to be
+    fully matched.
+    '''
+    candidates = [i for i in order if i in shapes]
+    counts = {}
+    for i in candidates:
+        for position in shapes[i]:
+            counts[position] = counts.get(position, 0) + 1
+    if not counts:
+        return tuple(candidates)
+
+    # Split on the position that the most clauses care about
+    position = max(sorted(counts), key=counts.get)
+    branches = []
+    for is_collection in (True, False):
+        remaining = {}
+        for i in candidates:
+            required = shapes[i].get(position)
+            if required is None or required == is_collection:
+                shape = dict(shapes[i])
+                shape.pop(position, None)
+                remaining[i] = shape
+        branches.append(_decide(candidates, remaining))
+
+    return _Decision(position, *branches)
 
 
 class Match_object:
@@ -401,38 +981,20 @@ class Match_object:
         the values that they matched.
         Returns a bool so that this can be used in an if/else.
         '''
-        tokens = pattern_str.replace('(', ' ( ').replace(')', ' ) ').split()
-        pattern = next(self.parse(tokens))
-        t = Template(pattern)
-        if t == self.val:
-            self.map = t.map
-            if self.decorated:
-                self._bind_to_calling_scope()
-            return True
+        matcher = compile_pattern(pattern_str)
+        if _observing:
+            bindings = _observed(matcher, self.val, matcher._match)
         else:
-            print(t.map)
+            bindings = matcher._match(self.val)
+        if bindings is None:
             return False
 
-    def parse(self, tokens):
-        '''
-        Convert a string representation of the template to
-        a - potentially nested - tuple that we can iterate over.
-        '''
-        tokens = iter(tokens)
-        for t in tokens:
-            if t == '(':
-                group = []
-                t = next(tokens)
-                if t == ')':
-                    raise SyntaxError('Empty match template')
-                else:
-                    while t != ')':
-                        tokens = chain([t], tokens)
-                        group.append(next(self.parse(tokens)))
-                        t = next(tokens)
-                    yield tuple(group)
-            else:
-                yield t
+        self.map = bindings
+        if self.decorated:
+            self._bind_to_calling_scope()
+        return True
+
+    parse = staticmethod(parse)
 
     def _bind_to_calling_scope(self):
         '''
@@ -0,0 +1,60 @@
+'''
+Shared machinery for decorators that rewrite a function from its source.
+'''
+import ast
+from functools import update_wrapper
+from inspect import getsource
+from textwrap import dedent
+from types import CodeType, FunctionType
+
+
+def recompile(func, rewrite, **bindings):
+    '''
+    Recompile func from its source after rewrite(fdef) has modified its
+    ast.FunctionDef in place. rewrite can return False to give up.
+    The keyword arguments are made available to the new function under
+    their names. Returns None if func can not be rewritten.
+    '''
+    if func.__code__.co_freevars or hasattr(func, '__wrapped__'):
+        # We can't recreate the closure or whatever func is wrapping
+        return None
+
+    try:
+        tree = ast.parse(dedent(getsource(func)))
+    except (OSError, TypeError, SyntaxError):
+        return None
+
+    fdef = tree.body[0]
+    if not isinstance(fdef, ast.FunctionDef) or fdef.name != func.__name__:
+        # e.g. a lambda
+        return None
+
+    if rewrite(fdef) is False:
+        return None
+
+    # Decorators, defaults and annotations have already been evaluated
+    # for func and are copied over from there.
+    fdef.decorator_list = []
+    fdef.returns = None
+    fdef.args.defaults = []
+    fdef.args.kw_defaults = [None] * len(fdef.args.kw_defaults)
+    for arg in ast.walk(fdef.args):
+        if isinstance(arg, ast.arg):
+            arg.annotation = None
+
+    # Wrap the definition in a factory so that the new function shares
+    # the original's globals without adding anything to them.
+    factory = ast.parse('def _recompiled({}):\n    return None'.format(
+        ', '.join(bindings))).body[0]
+    factory.body = [fdef, ast.Return(ast.Name(fdef.name, ast.Load()))]
+    tree.body = [factory]
+    ast.fix_missing_locations(tree)
+    ast.increment_lineno(tree, func.__code__.co_firstlineno - 1)
+
+    module = compile(tree, func.__code__.co_filename, 'exec')
+    factory_code = next(c for c in module.co_consts if isinstance(c, CodeType))
+    make = FunctionType(factory_code, func.__globals__)
+    new = make(**bindings)
+    new.__defaults__ = func.__defaults__
+    new.__kwdefaults__ = func.__kwdefaults__
+    return update_wrapper(new, func)
@@ -2,57 +2,665 @@
 @tcall is a simple tail call optimisation decorator in pure python
 You _will_ loose stack frame information for debugging so be warned!
 '''
+import ast
+from collections import OrderedDict, namedtuple
 from functools import wraps
+from inspect import getfullargspec, isawaitable
+from time import perf_counter
 
+from .recompile import recompile
 
-def tcall(func):
+
+class TailCall:
+    '''
+    Return one of these from a tcall function to make a tail call:
+
+        return TailCall(fact, n-1, acc*n)
+
+    The trampoline then calls func with the given positional and keyword
+    arguments in place of the current call.
+    '''
+    __slots__ = 'func args kwargs'.split()
+
+    def __init__(self, func, *args, **kwargs):
+        # Calling the original of another tcall function keeps chained
+        # tail calls inside a single trampoline.
+        if getattr(func, '_tcalling', None):
+            func = func._original
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return 'TailCall({}, *{}, **{})'.format(
+            getattr(self.func, '__name__', self.func), self.args, self.kwargs)
+
+
+def tcall(func=None, tuples=True, loop=False, memo=False, instrument=False):
     '''
     Tail call optimise a function. This decorator will run your function
     in a while loop which can also call out to other functions.
-    Any function being called in the tail call position _must_ return a
-    tuple of (func, args, kwargs) in order to genreate the tail call:
+    A function in the tail call position should return a TailCall object
+    naming the next function and its arguments. Anything else is treated
+    as the answer.
 
-        `func`      is the next function to be called. Setting this to None
-                    will cause the value of args to be returned as the answer.
+    For backwards compatibility, a tuple of (func, args, kwargs) will also
+    generate a tail call:
+
+        `func`      is the next function to be called. If this is not
+                    callable then the tuple is returned as the answer.
         `args`      is a tuple of the next positional arguments to the
                     function call.
         `kwargs`    is an optional dictionary of keyword arguments for the
                     next function call.
+
+    Use @tcall(tuples=False) to turn this off: results that happen to be
+    tuples starting with a callable are then returned as they are and each
+    bounce only costs a single type check.
+
+    With @tcall(loop=True) the function is recompiled from its source so
+    that tail calls to itself reassign the parameters and go round a
+    `while True` loop instead of bouncing off the trampoline. Any other
+    tail calls still use the trampoline, as does the whole function if it
+    can not be rewritten (closures, generators, *args or **kwargs...) or
+    if rewriting it could change its behaviour: locals captured by inner
+    functions or locals that might be read before they are assigned.
+
+    @tcall(memo=True) remembers the final result of every bounce keyed on
+    the function and arguments of that bounce, so repeated or overlapping
+    calls can stop as soon as they reach a bounce that has been seen
+    before. Pass an int instead of True to keep at most that many results
+    in an LRU cache. Arguments must be hashable to be cached and the
+    functions should be pure. wrapped.cache_info() and wrapped.cache_clear()
+    work in the same way as for functools.lru_cache.
+    NOTE: Self tail calls that have been rewritten with loop=True never
+          bounce so only the outer call is cached for those.
+
+    Passing instrument=True (or calling <original_func>.instrument() later)
+    records the number of steps taken into each target function and the
+    cumulative time spent in them, along with a histogram of the number of
+    steps in each chain. Use <original_func>.metrics() to get a snapshot
+    of what has been recorded. When instrumentation is off the only cost
+    is a single check per call.
     '''
+    if func is None:
+        return lambda f: tcall(f, tuples, loop, memo, instrument)
+
+    if loop:
+        func = _as_loop(func, tuples) or func
+
     # stash the original function so we can use it in tail calls
     # NOTE: if the user returns "the original" we are actually getting the
     #       decorated version.
     original = func
+    stats = _Stats()
+
+    if tuples:
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            if stats.enabled:
+                return _measured(func, tuples, stats, args, kwargs)
+
+            result = func(*args, **kwargs)
+
+            while True:
+                cls = type(result)
+                if cls is TailCall:
+                    result = result.func(*result.args, **result.kwargs)
+                    continue
+
+                if cls is tuple:
+                    # Unpacked inline: this is the hot path for old code
+                    if not result or not callable(result[0]):
+                        return result
+                    if len(result) == 2:
+                        f, args = result
+                        kwargs = {}
+                    elif len(result) == 3:
+                        f, args, kwargs = result
+                    else:
+                        raise IndexError(
+                            'tcall functions must return (func, args, kwargs)'
+                            ' or (func, args)')
+                    if getattr(f, '_tcalling', None):
+                        f = f._original
+                else:
+                    call = _from_tuple(result)
+                    if call is None:
+                        return result
+                    f, args, kwargs = call
+
+                result = f(*args, **kwargs)
+    else:
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            if stats.enabled:
+                return _measured(func, tuples, stats, args, kwargs)
+
+            result = func(*args, **kwargs)
+
+            while type(result) is TailCall:
+                result = result.func(*result.args, **result.kwargs)
+
+            return result
+
+    if memo is not False and memo is not None:
+        cache = _Memo(None if memo is True else memo)
+        wrapped = _memoised(func, tuples, cache, stats)
+        wrapped.cache_info = cache.info
+        wrapped.cache_clear = cache.clear
+
+    wrapped.instrument = stats.instrument
+    wrapped.metrics = stats.metrics
+    wrapped._tcalling = True
+    wrapped._original = original
+
+    if instrument:
+        stats.instrument()
+
+    return wrapped
+
+
+def atcall(func=None, tuples=True):
+    '''
+    Tail call optimise a coroutine function. This works in the same way as
+    tcall but the decorated function is a coroutine function that awaits
+    each step: tail calls may name either normal or async functions.
+    Every step runs in the calling task so an async state machine can
+    bounce forever in constant stack and memory.
+    '''
+    if func is None:
+        return lambda f: atcall(f, tuples)
 
     @wraps(func)
-    def wrapped(*args, **kwargs):
+    async def wrapped(*args, **kwargs):
         f = func
 
-        while f:
+        while True:
             result = f(*args, **kwargs)
-            try:
-                f, *result_or_args = result
-                if not callable(f):
-                    # we just pulled apart a result
-                    return result
-            except TypeError:
-                # got a raw result so return it
+            if isawaitable(result):
+                result = await result
+
+            if type(result) is TailCall:
+                f, args, kwargs = result.func, result.args, result.kwargs
+                continue
+
+            call = _from_tuple(result) if tuples else None
+            if call is None:
                 return result
+            f, args, kwargs = call
 
-            # Allow for chained tailcalling functions
-            f = f._original if getattr(f, '_tcalling', None) else f
+    wrapped._tcalling = True
+    wrapped._original = func
 
-            if len(result_or_args) > 2 or len(result_or_args) == 0:
-                raise IndexError(
-                    'tcall functions must return (func, args, kwargs)'
-                    ' or (func, args)')
+    return wrapped
 
-            try:
-                args, kwargs = result_or_args
-            except ValueError:
-                args, kwargs = result_or_args[0], {}
 
-    wrapped._tcalling = True
-    wrapped._original = original
+def _memoised(func, tuples, cache, stats):
+    '''
+    The trampoline with a memo cache: every bounce is looked up in the
+    cache and once the chain finishes, all of its bounces are stored
+    against the final result.
+    '''
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        f = func
+        pending = []
+        measured = stats.enabled
+        length = 0
+
+        while True:
+            key = _memo_key(f, args, kwargs)
+            result = cache.lookup(key)
+            if result is not _MISSING:
+                break
+
+            if key is not None:
+                pending.append(key)
+            if measured:
+                length += 1
+                result = stats.call(f, args, kwargs)
+            else:
+                result = f(*args, **kwargs)
+
+            if type(result) is TailCall:
+                f, args, kwargs = result.func, result.args, result.kwargs
+                continue
+
+            call = _from_tuple(result) if tuples else None
+            if call is None:
+                break
+            f, args, kwargs = call
+
+        cache.store(pending, result)
+        if measured:
+            stats.chain(length)
+        return result
 
     return wrapped
+
+
+def _measured(func, tuples, stats, args, kwargs):
+    '''
+    The trampoline with every step timed and counted.
+    '''
+    f = func
+    length = 0
+
+    while True:
+        length += 1
+        result = stats.call(f, args, kwargs)
+
+        if type(result) is TailCall:
+            f, args, kwargs = result.func, result.args, result.kwargs
+            continue
+
+        call = _from_tuple(result) if tuples else None
+        if call is None:
+            break
+        f, args, kwargs = call
+
+    stats.chain(length)
+    return result
+
+
+class _Stats:
+    '''
+    Instrumentation for a tcall function: [steps, cumulative time] for each
+    target function and the number of chains of each length.
+    '''
+    __slots__ = 'enabled targets chains'.split()
+
+    def __init__(self):
+        self.enabled = False
+        self.targets = {}
+        self.chains = {}
+
+    def instrument(self, enabled=True):
+        '''
+        Turn tail call metrics on or off. Enabling instrumentation discards
+        anything that was previously recorded.
+        '''
+        if enabled:
+            self.targets.clear()
+            self.chains.clear()
+        self.enabled = enabled
+
+    def metrics(self):
+        '''
+        Snapshot of the recorded metrics: steps and time for each target
+        function and a histogram of chain lengths (in steps).
+        '''
+        return {
+            'targets': {
+                f: {'steps': steps, 'time': elapsed}
+                for f, (steps, elapsed) in self.targets.items()
+            },
+            'chains': dict(sorted(self.chains.items())),
+        }
+
+    def call(self, f, args, kwargs):
+        start = perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            stats = self.targets.get(f)
+            if stats is None:
+                stats = self.targets[f] = [0, 0.0]
+            stats[0] += 1
+            stats[1] += perf_counter() - start
+
+    def chain(self, length):
+        self.chains[length] = self.chains.get(length, 0) + 1
+
+
+def _memo_key(func, args, kwargs):
+    '''
+    The cache key for a bounce or None if the arguments are unhashable.
+    '''
+    key = (func, args, frozenset(kwargs.items())) if kwargs else (func, args)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+_MISSING = object()
+_CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class _Memo:
+    '''
+    Results of tail call chains keyed on each of their bounces. If maxsize
+    is None the cache is unbounded, otherwise the least recently used
+    results are dropped first.
+    '''
+    __slots__ = 'results maxsize hits misses'.split()
+
+    def __init__(self, maxsize=None):
+        self.results = OrderedDict()
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+
+    def lookup(self, key):
+        if key is None:
+            return _MISSING
+
+        try:
+            result = self.results[key]
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+
+        self.hits += 1
+        if self.maxsize is not None:
+            self.results.move_to_end(key)
+        return result
+
+    def store(self, keys, result):
+        results = self.results
+        if self.maxsize is None:
+            for key in keys:
+                results[key] = result
+            return
+
+        # Store the outermost bounces last so that they are the most
+        # recently used: they are the most likely to be repeated.
+        for key in reversed(keys[:self.maxsize]):
+            results[key] = result
+            results.move_to_end(key)
+        while len(results) > self.maxsize:
+            results.popitem(last=False)
+
+    def info(self):
+        return _CacheInfo(
+            self.hits, self.misses, self.maxsize, len(self.results))
+
+    def clear(self):
+        self.results.clear()
+        self.hits = self.misses = 0
+
+
+def _from_tuple(result):
+    '''
+    Pull apart an old style (func, args, kwargs) result.
+    Returns None if the result is a raw value instead.
+    '''
+    try:
+        f, *result_or_args = result
+        if not callable(f):
+            # we just pulled apart a result
+            return None
+    except TypeError:
+        # got a raw result so return it
+        return None
+
+    if len(result_or_args) > 2 or len(result_or_args) == 0:
+        raise IndexError(
+            'tcall functions must return (func, args, kwargs)'
+            ' or (func, args)')
+
+    try:
+        args, kwargs = result_or_args
+    except ValueError:
+        args, kwargs = result_or_args[0], {}
+
+    # Allow for chained tailcalling functions
+    f = f._original if getattr(f, '_tcalling', None) else f
+    return f, args, kwargs
+
+
+def _as_loop(func, tuples):
+    '''
+    Recompile func from its source with self tail calls replaced by
+    reassigning the parameters and continuing round a loop. Returns None
+    if func can not be rewritten.
+    '''
+    code = func.__code__
+    spec = getfullargspec(func)
+    if spec.varargs or spec.varkw or code.co_cellvars or \
+            code.co_flags & _GENERATOR_FLAGS:
+        # Anything capturing a local would see it change under its feet
+        return None
+
+    positional = spec.args
+    defaults = dict(zip(reversed(positional), reversed(spec.defaults or ())))
+    defaults.update(spec.kwonlydefaults or {})
+
+    def as_loop(fdef):
+        by_keyword = set(
+            positional[len(getattr(fdef.args, 'posonlyargs', ())):])
+        by_keyword.update(spec.kwonlyargs)
+        rewriter = _LoopRewriter(
+            func.__name__, positional, by_keyword, spec.kwonlyargs, defaults,
+            tuples)
+
+        body = fdef.body
+        docstring = []
+        if body and isinstance(body[0], ast.Expr) and isinstance(getattr(
+                body[0].value, 'value', getattr(body[0].value, 's', None)),
+                str):
+            docstring, body = body[:1], body[1:]
+
+        # Locals now live on from one time round the loop to the next so
+        # they must not be readable before they are assigned.
+        params = set(positional + spec.kwonlyargs)
+        local = set(code.co_varnames) - params
+        try:
+            _assigned(body, params, local)
+        except _ReadBeforeAssignment:
+            return False
+
+        body = rewriter.rewrite(body)
+        if not rewriter.rewritten:
+            return False
+
+        # Falling off the end of the loop body is falling off the end of func
+        loop = ast.parse('while True:\n    return None').body[0]
+        loop.body[:0] = body
+        fdef.body = docstring + [loop]
+
+    return recompile(func, as_loop, _tcall_defaults=defaults)
+
+
+class _ReadBeforeAssignment(Exception):
+    pass
+
+
+def _assigned(body, defined, local):
+    '''
+    The locals that are definitely assigned once body has run or None if
+    it never falls through. Raises _ReadBeforeAssignment if any of them
+    could be read before that. Only if statements are followed precisely:
+    anything read inside other compound statements must already be
+    assigned (or be bound by the statement itself, e.g. a for target).
+    '''
+    defined = set(defined)
+    for stmt in body:
+        if isinstance(stmt, ast.If):
+            _check_reads(stmt.test, defined, local)
+            branches = [_assigned(b, defined, local)
+                        for b in (stmt.body, stmt.orelse)]
+            branches = [b for b in branches if b is not None]
+            if not branches:
+                return None
+            defined = set.intersection(*branches)
+        elif isinstance(stmt, (ast.Return, ast.Raise, ast.Continue,
+                               ast.Break)):
+            _check_reads(stmt, defined, local)
+            return None
+        elif isinstance(stmt, ast.AugAssign):
+            _check_reads(stmt.value, defined, local)
+            _check_reads(stmt.target, defined, local, stored=True)
+        elif isinstance(stmt, (ast.Assign, ast.AnnAssign, ast.Expr)):
+            _check_reads(stmt, defined, local)
+            defined |= _stored(stmt, local)
+        elif isinstance(stmt, ast.Delete):
+            defined -= _stored(stmt, local, ctx=ast.Del)
+        elif isinstance(stmt, ast.With):
+            for item in stmt.items:
+                _check_reads(item.context_expr, defined, local)
+                if item.optional_vars is not None:
+                    defined |= _stored(item.optional_vars, local)
+            defined = _assigned(stmt.body, defined, local)
+            if defined is None:
+                return None
+        else:
+            bound = set()
+            if isinstance(stmt, ast.For):
+                bound = _stored(stmt.target, local)
+            elif isinstance(stmt, ast.Try):
+                bound = {h.name for h in stmt.handlers if h.name}
+            _check_reads(stmt, defined | bound, local)
+
+    return defined
+
+
+def _scope(node):
+    '''
+    Walk node without entering nested functions, lambdas or classes.
+    '''
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        yield node
+        todo.extend(
+            child for child in ast.iter_child_nodes(node)
+            if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                      ast.Lambda, ast.ClassDef)))
+
+
+def _stored(node, local, ctx=ast.Store):
+    return {n.id for n in _scope(node)
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ctx)
+            and n.id in local}
+
+
+def _check_reads(node, defined, local, stored=False):
+    ctx = (ast.Load, ast.Store) if stored else ast.Load
+    for n in _scope(node):
+        if isinstance(n, ast.Name) and isinstance(n.ctx, ctx) and \
+                n.id in local and n.id not in defined:
+            raise _ReadBeforeAssignment(n.id)
+
+
+# generator, coroutine, async generator and iterable coroutine
+_GENERATOR_FLAGS = 0x20 | 0x80 | 0x100 | 0x200
+
+
+class _LoopRewriter:
+    '''
+    Replaces `return` statements that tail call the function being
+    rewritten with an assignment to its parameters and a `continue`.
+    Only returns that are directly inside the loop (possibly nested in if
+    statements) are touched: anywhere else a `continue` would mean
+    something different.
+    '''
+    def __init__(self, name, positional, by_keyword, kwonly, defaults,
+                 tuples):
+        self.name = name
+        self.positional = positional
+        self.by_keyword = by_keyword
+        self.params = positional + kwonly
+        self.required = [p for p in self.params if p not in defaults]
+        self.tuples = tuples
+        self.rewritten = 0
+
+    def rewrite(self, body):
+        new_body = []
+        for stmt in body:
+            if isinstance(stmt, ast.If):
+                stmt.body = self.rewrite(stmt.body)
+                stmt.orelse = self.rewrite(stmt.orelse)
+            elif isinstance(stmt, ast.Return) and \
+                    isinstance(stmt.value, ast.IfExp):
+                # return a if test else b
+                rewritten = self.rewritten
+                branches = ast.copy_location(ast.If(
+                    stmt.value.test,
+                    [ast.copy_location(ast.Return(stmt.value.body), stmt)],
+                    [ast.copy_location(ast.Return(stmt.value.orelse), stmt)],
+                ), stmt)
+                branches.body = self.rewrite(branches.body)
+                branches.orelse = self.rewrite(branches.orelse)
+                if self.rewritten > rewritten:
+                    new_body.append(branches)
+                    continue
+            elif isinstance(stmt, ast.Return) and stmt.value is not None:
+                assignment = self.tail_call(stmt.value)
+                if assignment is not None:
+                    self.rewritten += 1
+                    new_body.extend([ast.copy_location(assignment, stmt),
+                                     ast.copy_location(ast.Continue(), stmt)])
+                    continue
+            new_body.append(stmt)
+        return new_body
+
+    def is_self(self, node):
+        return isinstance(node, ast.Name) and node.id == self.name
+
+    def tail_call(self, value):
+        '''
+        The parameter assignment for a self tail call or None if value is
+        anything else.
+        '''
+        if isinstance(value, ast.Call) and isinstance(
+                value.func, ast.Name) and value.func.id == 'TailCall' and \
+                value.args and self.is_self(value.args[0]):
+            # TailCall(func, *args, **kwargs)
+            return self.assign(value.args[1:], value.keywords)
+        if isinstance(value, ast.Call) and self.is_self(value.func):
+            # func(*args, **kwargs)
+            return self.assign(value.args, value.keywords)
+        if self.tuples and isinstance(value, ast.Tuple) and \
+                len(value.elts) in (2, 3) and self.is_self(value.elts[0]):
+            # (func, args) or (func, args, kwargs)
+            args = value.elts[1]
+            kwargs = value.elts[2] if len(value.elts) == 3 else \
+                ast.Dict([], [])
+            if not isinstance(args, ast.Tuple) or \
+                    not isinstance(kwargs, ast.Dict):
+                return None
+            keys = [getattr(k, 'value', getattr(k, 's', None))
+                    for k in kwargs.keys]
+            if not all(isinstance(k, str) for k in keys):
+                return None
+            keywords = [ast.keyword(k, v) for k, v in zip(keys, kwargs.values)]
+            return self.assign(args.elts, keywords)
+        return None
+
+    def assign(self, args, keywords):
+        '''
+        Simultaneously assign the arguments of a call to the parameters
+        they bind to, using defaults for anything left out. Returns None if
+        the call can not be bound statically (or would fail).
+        '''
+        if any(isinstance(a, ast.Starred) for a in args) or \
+                len(args) > len(self.positional):
+            return None
+
+        names = self.positional[:len(args)]
+        values = list(args)
+        for keyword in keywords:
+            if keyword.arg is None or keyword.arg in names or \
+                    keyword.arg not in self.by_keyword:
+                # **kwargs, duplicates or unknown names
+                return None
+            names.append(keyword.arg)
+            values.append(keyword.value)
+
+        if any(p not in names for p in self.required):
+            return None
+        for param in self.params:
+            if param not in names:
+                names.append(param)
+                values.append(ast.parse(
+                    '_tcall_defaults[{!r}]'.format(param), mode='eval').body)
+
+        if not names:
+            return ast.Pass()
+        return ast.Assign(
+            [ast.Tuple([ast.Name(n, ast.Store()) for n in names],
+                       ast.Store())],
+            ast.Tuple(values, ast.Load()))